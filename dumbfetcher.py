@@ -10,13 +10,23 @@ if __name__ == '__main__':
     import logging
     import argparse
     import kstreams
+    import os
     import sys
 
     parser = argparse.ArgumentParser()
     parser.add_argument('mode',
-                        choices=['init', 'update', 'update-newest', 'fetch'])
+                        choices=['init', 'update', 'update-newest', 'fetch',
+                                 'rebalance', 'import', 'export'])
     parser.add_argument('path', nargs='?', default=None)
     parser.add_argument('-v', '--verbose', action='count', default=0)
+    parser.add_argument('--shard', type=int, default=None,
+                        help='the shard to update or fetch')
+    parser.add_argument('--shards', type=int, default=None,
+                        help='the number of shards to init or rebalance')
+    parser.add_argument('--archive', default=None,
+                        help='the legacy database to import or export')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='the number of processes used to import')
     args = parser.parse_args()
 
     if args.path:
@@ -37,18 +47,40 @@ if __name__ == '__main__':
         handlers = [logging.FileHandler('kstreams.log')]
     logging.basicConfig(level=loglevel, handlers=handlers)
 
+    def open_db():
+        if not os.path.exists(os.path.join(path, 'shards.json')):
+            return kstreams.SongDB(path)
+        if args.shard is None:
+            parser.error('the database is sharded, a --shard is required')
+        return kstreams.ShardedSongDB(path).shards[args.shard]
+
     if args.mode == 'init':
-        kstreams.init_db(path)
+        kstreams.init_db(path, shards=args.shards)
+    elif args.mode == 'rebalance':
+        if not args.shards:
+            parser.error('rebalance requires --shards')
+        kstreams.ShardedSongDB(path).rebalance(args.shards)
+    elif args.mode in ('import', 'export'):
+        if not args.archive:
+            parser.error('{} requires --archive'.format(args.mode))
+        if os.path.exists(os.path.join(path, 'shards.json')):
+            db = kstreams.ShardedSongDB(path)
+        else:
+            db = kstreams.SongDB(path)
+        if args.mode == 'import':
+            kstreams.import_db(args.archive, db, workers=args.workers)
+        else:
+            kstreams.export_db(db, args.archive)
     elif args.mode == 'update':
-        db = kstreams.SongDB(path)
+        db = open_db()
         db.update()
         db.save()
     elif args.mode == 'update-newest':
-        db = kstreams.SongDB(path)
+        db = open_db()
         db.update(fetch_newest=True)
         db.save()
     elif args.mode == 'fetch':
-        db = kstreams.SongDB(path)
+        db = open_db()
         db.fetch()
         db.save()
     sys.exit()
@@ -15,11 +15,18 @@ Usage of the package revolves around two classes:
 
 - the Song class represent a single entry in a database.
 
+A database can also be split into shards kept up to date by separate
+processes, through the ShardedSongDB class. Databases in the legacy
+layout, such as old dumps, can be imported with the import_db()
+function and exported with export_db().
+
 Please refer to the docstrings of the classes to learn more about
 their usage.
 """
 
-from .classes import Song, SongDB, init_db
+from ._migration import export_db, import_db
+from .classes import Song, SongDB, ShardedSongDB, init_db
 
 name = 'kstreams'
-__all__ = ['Song', 'SongDB', 'init_db']
+__all__ = ['Song', 'SongDB', 'ShardedSongDB', 'init_db', 'import_db',
+           'export_db']
@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import concurrent.futures
+import io
+import json
+import logging
+import os
+import tarfile
+import time
+
+import numpy as np
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # memory usage is only reported on Unix systems
+    resource = None
+
+from ._storage import (
+    atomic_path,
+    commit_path,
+    discard_path,
+    file_version,
+    locked,
+    temp_path,
+)
+from ._utils import shard_of
+
+CHECKPOINT_NAME = 'migration.jsonl'
+
+
+def import_db(source, db, workers=None):
+    """Imports a database in the legacy layout into the given database.
+
+    The legacy layout is a directory holding a pickled table for each
+    song, along with the songs.json and blacklist.json files, either
+    on disk or packed in a tarball such as those made by export_db().
+    Tarballs are read as a stream, without extracting them to disk,
+    and the data of the songs are converted in parallel by a pool of
+    worker processes, so that only the songs being converted are held
+    in memory at any time.
+
+    The data of every song are validated while converting them. Songs
+    whose data can't be read are reported and left out, while songs
+    whose totals decrease or are negative are reported and imported
+    anyway. Songs already in the database have the imported data
+    merged with their own.
+
+    The import can be resumed after being interrupted by calling this
+    function again with the same arguments: the songs already imported
+    from the same source, recorded in a migration.jsonl file in the
+    database directory, are skipped. A source is identified by its path,
+    size and modification time, and its records are removed once its
+    import is completed, so that newer dumps of the same database can
+    be imported in turn.
+
+    The song metadata and the blacklist are saved last, and the songs
+    added to the database are recorded in its change log as 'add'
+    events. The samples imported are not recorded in it.
+
+    Args:
+        source: the path to the legacy database directory or tarball.
+        db: the SongDB or ShardedSongDB instance to import into.
+        workers: the number of worker processes. Defaults to the
+            number of CPUs.
+
+    Returns:
+        A dictionary reporting the number of songs 'imported', 'skipped'
+        as already imported and 'failed', along with the 'rows' and
+        'bytes' of data read, the 'seconds' elapsed, the throughput in
+        'songs_per_second', 'rows_per_second' and 'mb_per_second', the
+        'peak_memory_mb' of the importing process plus that of the
+        largest worker, and the 'problems' found, as a dictionary from
+        song ID to a list of messages.
+    """
+    checkpoint_path = os.path.join(db.path, CHECKPOINT_NAME)
+    source_key = _source_key(source)
+    done = _read_checkpoint(checkpoint_path, source_key)
+    workers = workers or os.cpu_count() or 1
+    report = {'imported': 0, 'skipped': 0, 'failed': 0, 'rows': 0,
+              'bytes': 0, 'problems': {}}
+    metadata = {}
+    start = time.perf_counter()
+
+    def collect(future):
+        result = future.result()
+        if result['problems']:
+            report['problems'][result['id']] = result['problems']
+        if result['rows'] is None:
+            report['failed'] += 1
+            return
+        report['imported'] += 1
+        report['rows'] += result['rows']
+        with open(checkpoint_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(dict(result, source=source_key)) + '\n')
+        if report['imported'] % 500 == 0:
+            logging.info('%d songs imported', report['imported'])
+
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        pending = set()
+        for name, data in _iter_legacy(source):
+            report['bytes'] += len(data)
+            if name in ('songs.json', 'blacklist.json'):
+                metadata[name] = json.loads(data.decode('utf-8'))
+                continue
+            songid = name[:-len('.pkl')]
+            if songid in done:
+                report['skipped'] += 1
+                continue
+            target = _target(db, songid)
+            pending.add(executor.submit(_convert, songid, data,
+                                        target._pkl_path(songid),
+                                        target._lock_path))
+            # bound the number of songs held in memory
+            if len(pending) >= 4 * workers:
+                finished, pending = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    collect(future)
+        for future in concurrent.futures.as_completed(pending):
+            collect(future)
+
+    _import_metadata(db, metadata.get('songs.json', {}),
+                     metadata.get('blacklist.json', []),
+                     _read_checkpoint(checkpoint_path, source_key), report)
+    _clear_checkpoint(checkpoint_path, source_key)
+
+    report['seconds'] = time.perf_counter() - start
+    seconds = max(report['seconds'], 1e-9)
+    report['songs_per_second'] = report['imported'] / seconds
+    report['rows_per_second'] = report['rows'] / seconds
+    report['mb_per_second'] = report['bytes'] / 2 ** 20 / seconds
+    report['peak_memory_mb'] = _peak_memory()
+    logging.info('Import completed: %d songs imported, %d skipped, %d '
+                 'failed in %.1f s (%.1f songs/s, %.1f MB/s, peak memory '
+                 '%s MB)', report['imported'], report['skipped'],
+                 report['failed'], report['seconds'],
+                 report['songs_per_second'], report['mb_per_second'],
+                 report['peak_memory_mb'])
+    return report
+
+
+def export_db(db, dest):
+    """Exports a database to a tarball in the legacy layout.
+
+    The tarball holds a db directory with a pickled table for each
+    song, the songs.json and the blacklist.json files, as in the
+    database dumps made before the introduction of the current
+    storage features. Sharded databases are merged into a single
+    directory. The files are written to the tarball one at a time.
+
+    Args:
+        db: the SongDB or ShardedSongDB instance to export.
+        dest: the path of the tarball. Its compression is chosen from
+            the extension, e.g. '.tar.gz'.
+
+    Returns:
+        The number of songs exported.
+    """
+    shards = getattr(db, 'shards', [db])
+    songs = {}
+    blacklist = []
+    mode = 'w:' + _compression(dest)
+    with tarfile.open(dest, mode) as tar:
+        for shard in shards:
+            for songid in shard._songs:
+                tar.add(shard._pkl_path(songid),
+                        arcname='db/{}.pkl'.format(songid))
+            songs.update(shard._songs)
+            blacklist.extend(songid for songid in shard.blacklist
+                             if songid not in blacklist)
+        _add_json(tar, 'db/blacklist.json', blacklist, indent=0)
+        _add_json(tar, 'db/songs.json', songs, indent=4, ensure_ascii=False)
+    logging.info('%d songs exported to %s', len(songs), dest)
+    return len(songs)
+
+
+def _iter_legacy(source):
+    # Yields the names and contents of the files of a legacy database
+    # one at a time
+    names = ('songs.json', 'blacklist.json')
+    if os.path.isdir(source):
+        for entry in sorted(os.scandir(source), key=lambda e: e.name):
+            if entry.name.endswith('.pkl') or entry.name in names:
+                with open(entry.path, 'rb') as f:
+                    yield entry.name, f.read()
+        return
+    with tarfile.open(source, 'r|*') as tar:
+        for member in tar:
+            name = os.path.basename(member.name)
+            if member.isfile() and (name.endswith('.pkl') or name in names):
+                yield name, tar.extractfile(member).read()
+
+
+def _convert(songid, data, path, lock_path):
+    # Runs in a worker process: validates the data of a song, merges
+    # them with the data already in the database and stores them
+    problems = []
+    try:
+        table = pd.read_pickle(io.BytesIO(data))
+        table = table[['plays', 'listeners']]
+        table.index = pd.DatetimeIndex(table.index)
+    except Exception as e:
+        return {'id': songid, 'rows': None,
+                'problems': ['unreadable data: {!r}'.format(e)]}
+    if table.index.tz is None:
+        problems.append('timestamps without time zone, assumed UTC')
+        table.index = table.index.tz_localize('UTC')
+    if not table.index.is_monotonic_increasing:
+        problems.append('timestamps out of order')
+    imported = table
+    # the data are merged and written without holding the lock, which
+    # is only taken to replace the file. If the song has been fetched
+    # in the meantime, the merge is done again with the new data.
+    version = file_version(path)
+    table = _merge(path, imported)
+    tmp_path = temp_path(path)
+    try:
+        table.to_pickle(tmp_path)
+        with locked(lock_path):
+            if file_version(path) != version:
+                table = _merge(path, imported)
+                table.to_pickle(tmp_path)
+            commit_path(tmp_path, path)
+    finally:
+        discard_path(tmp_path)
+    if len(pd.read_pickle(path)) < len(table):
+        problems.append('rows lost while writing')
+    for column in ('plays', 'listeners'):
+        values = table[column].dropna().values
+        if (values < 0).any():
+            problems.append('negative {}'.format(column))
+        if (np.diff(values) < 0).any():
+            problems.append('decreasing {} totals'.format(column))
+    return {'id': songid, 'rows': len(table), 'problems': problems,
+            'first': table.index[0].isoformat() if len(table) else None,
+            'last': table.index[-1].isoformat() if len(table) else None}
+
+
+def _merge(path, table):
+    if os.path.exists(path):
+        table = pd.concat([pd.read_pickle(path), table], sort=True)
+    return table.sort_index().drop_duplicates()
+
+
+def _import_metadata(db, songs, blacklist, imported, report):
+    for songid in set(imported) - set(songs):
+        report['problems'].setdefault(songid, []).append(
+            'data without metadata')
+    for songid, info in songs.items():
+        if songid not in imported:
+            report['problems'].setdefault(songid, []).append(
+                'metadata without data')
+            continue
+        target = _target(db, songid)
+        if songid not in target:
+            target._songs[songid] = info
+            target._index_song(songid)
+            target._events.append(target._event(
+                'add', songid, title=info.get('title'),
+                artist=info.get('artist')))
+    for songid in blacklist:
+        target = _target(db, songid)
+        if songid not in target.blacklist:
+            target.blacklist.append(songid)
+    db.save()
+
+
+def _target(db, songid):
+    # the SongDB in which a song is stored
+    shards = getattr(db, 'shards', None)
+    if shards is None:
+        return db
+    return shards[shard_of(songid, db.count)]
+
+
+def _source_key(source):
+    # Identifies a legacy database by its path, and by the size and the
+    # modification time of its tarball or of its songs.json file
+    path = os.path.abspath(source)
+    stat_path = path
+    if os.path.isdir(path):
+        stat_path = os.path.join(path, 'songs.json')
+        if not os.path.exists(stat_path):
+            stat_path = path
+    stat = os.stat(stat_path)
+    return '{}:{}:{}'.format(path, stat.st_size, stat.st_mtime_ns)
+
+
+def _read_checkpoint_entries(path):
+    entries = []
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:  # interrupted while writing
+                    continue
+    except FileNotFoundError:
+        pass
+    return entries
+
+
+def _read_checkpoint(path, source_key):
+    return {entry['id']: entry['rows']
+            for entry in _read_checkpoint_entries(path)
+            if entry.get('source') == source_key}
+
+
+def _clear_checkpoint(path, source_key):
+    # keeps the records of other imports, which may be resumed later
+    entries = [entry for entry in _read_checkpoint_entries(path)
+               if entry.get('source') != source_key]
+    if not entries:
+        discard_path(path)
+        return
+    with atomic_path(path) as tmp_path:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + '\n')
+
+
+def _peak_memory():
+    if resource is None:
+        return None
+    usage = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss +
+             resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    scale = 2 ** 20 if os.uname().sysname == 'Darwin' else 2 ** 10
+    return round(usage / scale, 1)
+
+
+def _compression(path):
+    for ext, compression in (('gz', 'gz'), ('tgz', 'gz'), ('bz2', 'bz2'),
+                             ('xz', 'xz')):
+        if path.endswith('.' + ext):
+            return compression
+    return ''
+
+
+def _add_json(tar, name, obj, **kwargs):
+    data = json.dumps(obj, **kwargs).encode('utf-8')
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = time.time()
+    tar.addfile(info, io.BytesIO(data))
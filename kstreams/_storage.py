@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import contextlib
+import json
+import logging
+import os
+import tempfile
+import time
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # file locking is only supported on POSIX systems
+    fcntl = None
+
+
+@contextlib.contextmanager
+def locked(path):
+    # Holds an exclusive lock on the lock file at path. The lock is
+    # released when the process dies, so a crashed writer never leaves
+    # the database locked.
+    with open(path, 'a') as f:
+        if fcntl:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+@contextlib.contextmanager
+def atomic_path(path):
+    # Yields a temporary path to be written in place of path. When the
+    # block exits the temporary file is flushed to disk and renamed over
+    # path, so readers only ever see either the old or the new file.
+    tmp_path = temp_path(path)
+    try:
+        yield tmp_path
+        commit_path(tmp_path, path)
+    finally:
+        discard_path(tmp_path)
+
+
+def temp_path(path):
+    # Returns a new temporary file next to path, to be renamed over it
+    # by commit_path() once written
+    dirname = os.path.dirname(path) or '.'
+    fd, tmp_path = tempfile.mkstemp(
+        dir=dirname, prefix='.{}.'.format(os.path.basename(path)),
+        suffix='.tmp')
+    os.close(fd)
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(tmp_path, 0o666 & ~umask)
+    return tmp_path
+
+
+def commit_path(tmp_path, path):
+    _fsync(tmp_path)
+    os.replace(tmp_path, path)
+    _fsync_dir(os.path.dirname(path) or '.')
+
+
+def discard_path(tmp_path):
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(tmp_path)
+
+
+def dump_json(obj, path, **kwargs):
+    with atomic_path(path) as tmp_path:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(obj, f, **kwargs)
+
+
+def write_journal(path, ops):
+    # All the operations are written as a single line, so a save
+    # interrupted while writing the journal leaves behind a line that
+    # can't be parsed and is discarded on recovery.
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(json.dumps({'ops': ops}, ensure_ascii=False) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def read_journal(path):
+    ops = []
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    ops.extend(json.loads(line)['ops'])
+                except (ValueError, KeyError):
+                    break
+    except FileNotFoundError:
+        pass
+    return ops
+
+
+def clear_journal(path):
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(path)
+
+
+def append_changes(path, events):
+    # Must be called while holding the lock, so that the events of
+    # different processes are never interleaved
+    data = ''.join(json.dumps(event, ensure_ascii=False) + '\n'
+                   for event in events)
+    with open(path, 'ab') as f:
+        _truncate_partial_line(f)
+        f.write(data.encode('utf-8'))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _truncate_partial_line(f, chunk_size=4096):
+    # Removes the end of a file opened for appending if it isn't
+    # terminated by a newline, as left by an interrupted write
+    end = f.seek(0, os.SEEK_END)
+    position = end
+    with open(f.name, 'rb') as reader:
+        while position > 0:
+            start = max(position - chunk_size, 0)
+            reader.seek(start)
+            chunk = reader.read(position - start)
+            newline = chunk.rfind(b'\n')
+            if newline >= 0:
+                position = start + newline + 1
+                break
+            position = start
+    if position < end:
+        f.truncate(position)
+        logging.warning('Partial line removed from %s', f.name)
+
+
+def read_changes(path, since_offset=None, follow=False, poll_interval=1.0):
+    # The offset of an event is the position in bytes of its line in
+    # the file, which makes seeking to it immediate. Passing the offset
+    # of an event starts reading from the event following it.
+    while not os.path.exists(path):
+        if not follow:
+            return
+        time.sleep(poll_interval)
+    with open(path, 'rb') as f:
+        if since_offset is not None:
+            f.seek(since_offset)
+            f.readline()  # skip the event at the offset
+        while True:
+            offset = f.tell()
+            line = f.readline()
+            if line.endswith(b'\n'):
+                try:
+                    event = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    # left by a write interrupted before the partial
+                    # lines were removed on append
+                    logging.warning('Unreadable event at offset %d of %s '
+                                    'skipped', offset, path)
+                    continue
+                event['offset'] = offset
+                yield event
+            elif follow:
+                # wait for the line to be complete
+                f.seek(offset)
+                time.sleep(poll_interval)
+            else:
+                return
+
+
+# An hourly chart snapshot is stored as a fixed size record holding the
+# hour, in seconds since the epoch, and the song IDs by rank, with 0
+# marking the ranks missing from the snapshot
+CHART_SIZE = 200
+CHART_DTYPE = np.dtype([('hour', '<i8'), ('songs', '<u4', (CHART_SIZE,))])
+
+
+def append_chart(path, hour, songids):
+    # Must be called while holding the lock
+    record = np.zeros(1, dtype=CHART_DTYPE)
+    record['hour'] = hour
+    songids = [int(songid) for songid in songids[:CHART_SIZE]]
+    record['songs'][0, :len(songids)] = songids
+    with open(path, 'ab') as f:
+        # records are found by their position, so the end of a record
+        # left by an interrupted write would misalign the ones after it
+        end = f.seek(0, os.SEEK_END)
+        if end % CHART_DTYPE.itemsize:
+            f.truncate(end - end % CHART_DTYPE.itemsize)
+            logging.warning('Partial chart record removed from %s', path)
+        f.write(record.tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def read_charts(path):
+    # Returns the chart records sorted by hour. When an hour was
+    # recorded more than once, the last record is kept.
+    try:
+        count = os.path.getsize(path) // CHART_DTYPE.itemsize
+    except FileNotFoundError:
+        count = 0
+    # a record being appended by another process is left out
+    if count:
+        charts = np.fromfile(path, dtype=CHART_DTYPE, count=count)
+    else:
+        charts = np.zeros(0, dtype=CHART_DTYPE)
+    return dedup_charts(charts)
+
+
+def dedup_charts(charts):
+    _, last = np.unique(charts['hour'][::-1], return_index=True)
+    return charts[len(charts) - 1 - last]
+
+
+def diff_songs(old, new):
+    # Returns the operations turning the song metadata old into new
+    ops = []
+    for songid, info in new.items():
+        if songid not in old:
+            ops.append(['add', songid, info])
+            continue
+        for key, value in info.items():
+            if old[songid].get(key) != value:
+                ops.append(['set', songid, key, value])
+    for songid in old:
+        if songid not in new:
+            ops.append(['remove', songid])
+    return ops
+
+
+def diff_blacklist(old, new):
+    old, new = set(old), set(new)
+    return ([['blacklist', songid] for songid in new - old] +
+            [['unblacklist', songid] for songid in old - new])
+
+
+def apply_ops(songs, blacklist, ops):
+    # Applies the operations in place. Every operation sets an absolute
+    # value, so applying the same operations twice is harmless.
+    for op in ops:
+        if op[0] == 'add':
+            songs.setdefault(op[1], {}).update(op[2])
+        elif op[0] == 'set':
+            if op[1] in songs:
+                songs[op[1]][op[2]] = op[3]
+        elif op[0] == 'remove':
+            songs.pop(op[1], None)
+        elif op[0] == 'blacklist':
+            if op[1] not in blacklist:
+                blacklist.append(op[1])
+        elif op[0] == 'unblacklist':
+            while op[1] in blacklist:
+                blacklist.remove(op[1])
+
+
+def file_version(path):
+    # Identifies the version of a file replaced by commit_path(), or
+    # returns None if the file doesn't exist
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+def _fsync(path):
+    with open(path, 'rb') as f:
+        os.fsync(f.fileno())
+
+
+def _fsync_dir(path):
+    if os.name != 'posix':
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
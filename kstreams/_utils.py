@@ -1,6 +1,9 @@
 #!/usr/bin/env python3
 # coding: utf-8
 
+import hashlib
+import re
+
 import numpy as np
 import pandas as pd
 
@@ -18,3 +21,74 @@ def interpolate(s):
     interp[mask] = None
     return interp
 
+
+def normalize_name(name):
+    """Case folds a name and collapses its whitespace."""
+    return ' '.join(name.split()).casefold()
+
+
+def name_keys(name):
+    """Returns the lookup keys under which a name is indexed.
+
+    Besides its normalized form, a name carrying an alias in
+    parentheses, such as '브라더수 (Brothersu)', is also indexed under
+    each of its two forms.
+    """
+    name = normalize_name(name)
+    if not name:
+        return set()
+    keys = {name}
+    match = re.match(r'^(.+?)\s*\((.+)\)$', name)
+    if match:
+        keys.update(match.groups())
+    return keys
+
+
+def shard_of(songid, count):
+    """Returns the shard to which a song is assigned among count shards.
+
+    Shards are assigned by rendezvous hashing: every shard is scored by
+    hashing the song ID together with the shard number and the highest
+    scoring one wins. When shards are added, only the songs won by the
+    new shards change shard.
+    """
+    def score(n):
+        key = '{}:{}'.format(songid, n).encode()
+        return hashlib.md5(key).digest()
+    return max(range(count), key=score)
+
+
+def hourly_periods(hours):
+    """Converts hours in seconds since the epoch to KST periods."""
+    index = pd.to_datetime(hours, unit='s', utc=True)
+    return index.tz_convert('Asia/Seoul').to_period(pd.offsets.Hour())
+
+
+def rank_history(charts, songid):
+    """Returns the hourly ranks of a song in the given chart records."""
+    ranks = np.full(len(charts), np.nan)
+    rows, cols = np.nonzero(charts['songs'] == int(songid))
+    ranks[rows] = cols + 1
+    return pd.Series(ranks, index=hourly_periods(charts['hour']))
+
+
+def chart_run(ranks):
+    """Returns the chart run statistics of a series of hourly ranks."""
+    charted = ranks.dropna()
+    if charted.empty:
+        return {'peak': None, 'hours_at_peak': 0, 'first_charted': None,
+                'last_charted': None, 'hours_charted': 0,
+                'hours_in_top10': 0, 'mean_rank': None, 'longest_run': 0}
+    # runs are counted in consecutive chart records, so that an hour
+    # missing from the records doesn't break a run
+    positions = np.flatnonzero(ranks.notna().values)
+    run_ids = np.concatenate([[0], np.cumsum(np.diff(positions) != 1)])
+    peak = int(charted.min())
+    return {'peak': peak,
+            'hours_at_peak': int((charted == peak).sum()),
+            'first_charted': charted.index[0],
+            'last_charted': charted.index[-1],
+            'hours_charted': len(charted),
+            'hours_in_top10': int((charted <= 10).sum()),
+            'mean_rank': float(charted.mean()),
+            'longest_run': int(np.bincount(run_ids).max())}
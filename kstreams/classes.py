@@ -1,12 +1,17 @@
 #!/usr/bin/env python3
 # coding: utf-8
 
+import copy
 import json
 import logging
 import os
 import random
+import shutil
+import time
+from urllib.parse import urlparse
 
 import arrow
+import numpy as np
 import pandas as pd
 import requests
 
@@ -21,10 +26,44 @@ from ._scrapers import (
     SONGURL,
     ALBUMURL
 )
+from ._storage import (
+    append_chart,
+    append_changes,
+    apply_ops,
+    atomic_path,
+    clear_journal,
+    dedup_charts,
+    diff_blacklist,
+    diff_songs,
+    dump_json,
+    locked,
+    read_changes,
+    read_charts,
+    read_journal,
+    write_journal,
+)
 from ._utils import (
+    chart_run,
+    hourly_periods,
     interpolate,
+    name_keys,
+    normalize_name,
+    rank_history,
+    shard_of,
 )
 
+INDEXED_FIELDS = ('artist', 'agency')
+INDEXED_CREDITS = ('lyrics', 'composition', 'arrangement')
+
+FETCH_TIMEOUT = 10  # seconds before a request for a song's stats fails
+RETRY_BACKOFF = 60  # seconds before the first retry, doubled at each retry
+RETRY_WINDOW = 3300  # seconds after a failure in which retries are made
+BREAKER_THRESHOLD = 5  # consecutive failures suspending the retries
+BREAKER_COOLDOWN = 300  # seconds for which the retries are suspended
+
+# a generator of its own, as Song.minute seeds the global one
+_jitter = random.Random()
+
 
 class Song(object):
     """This class represents a single song from a database.
@@ -47,12 +86,16 @@ class Song(object):
 
     def __init__(self, db, songid):
         self.id = songid
-        self._info = db._songs[self.id]
+        self._parent = db
         self.title = self._info.get('title')
         self.artist = self._info.get('artist')
         self.agency = self._info.get('agency')
         self.release_date = arrow.get(self._info.get('release_date'))
-        self._db_path = os.path.join(db.path, '{}.pkl'.format(self.id))
+        self._db_path = db._pkl_path(self.id)
+
+    @property
+    def _info(self):
+        return self._parent._songs[self.id]
 
     @property
     def is_tracking(self):
@@ -68,7 +111,9 @@ class Song(object):
 
     @credits.setter
     def credits(self, value):
+        self._parent._unindex_song(self.id)
         self._info['credits'] = value
+        self._parent._index_song(self.id)
 
     @property
     def minute(self):
@@ -78,14 +123,22 @@ class Song(object):
         return self._info['minute']
 
     def fetch(self):
-        """Fetches and stores the current total play count from Genie."""
+        """Fetches and stores the current total play count from Genie.
+
+        Returns:
+            True if the play count has been stored, False if the request
+            to Genie failed.
+        """
         # scraping code
         try:
-            page = requests.get(SONGURL, {'xgnm': self.id})
-        except (requests.ConnectionError, requests.HTTPError):
+            page = requests.get(SONGURL, {'xgnm': self.id},
+                                timeout=FETCH_TIMEOUT)
+            page.raise_for_status()
+        except (requests.ConnectionError, requests.HTTPError,
+                requests.Timeout):
             logging.error('Request to genie.co.kr for song ID %s failed',
                           self.id)
-            return
+            return False
         markup = page.text
         if not self.credits:
             self.credits = scrape_credits(markup)
@@ -97,8 +150,11 @@ class Song(object):
         record = pd.DataFrame(stats, [pd.to_datetime(tstamp.datetime)])
         # save new record in the database
         self._db_append(record)
+        self._parent._publish([self._parent._event(
+            'sample', self.id, tstamp, **stats)])
         logging.info('Fetching completed: %s by %s',
                      self.title, self.artist)
+        return True
 
     def _get_stats(self):
         data = self._db
@@ -147,9 +203,11 @@ class Song(object):
         return self._get_stats()['listeners'].rename(self.title)
 
     def _db_append(self, record):
-        db = self._db.append(record, sort=True)
-        db = db.drop_duplicates()
-        db.to_pickle(self._db_path)
+        with locked(self._parent._lock_path):
+            db = pd.concat([self._db, record], sort=True)
+            db = db.drop_duplicates()
+            with atomic_path(self._db_path) as tmp_path:
+                db.to_pickle(tmp_path)
 
     @property
     def _db(self):
@@ -184,10 +242,32 @@ class SongDB(object):
     the 17th minute of every hour, and will be only fetched if the
     fetch() method of the SongDB instance is called at that time.
 
+    Several processes can work on the same database at once, e.g. a
+    fetch() and an update() run by overlapping cron jobs, and the
+    database can be read while it's being written. Every file is
+    written to a temporary file first and then renamed over the old
+    one, so readers never see a partially written file. Writers take
+    a lock on the database only for the time needed to commit their
+    changes: save() merges the changes made since the last load() into
+    the latest state on disk rather than overwriting it, and records
+    them in a journal beforehand, so that a save interrupted by a
+    crash is completed the next time the database is loaded.
+
+    Every change to the database is also recorded in a change log:
+    the samples stored by Song.fetch(), and the songs added, resumed
+    and pruned by update() and the other methods. Consumers of the
+    change log can follow it incrementally through the tail() method.
+
+    The real time top 200 fetched by update() is also stored, as an
+    hourly snapshot of the song IDs by rank, and can be queried through
+    the get_charts(), get_ranks() and get_chart_run() methods.
+
     In order to prevent the average load to exceed one request per
     second, a limited number of songs can be tracked at any given time
     and when the database exceeds that size a number of songs stops
-    being tracked further through a call to the prune() method.
+    being tracked further through a call to the prune() method. The
+    requests left over from the budget of a minute are used by fetch()
+    to retry the songs whose fetching failed earlier in the hour.
 
     Attributes:
         path: the path to the directory where the database files are stored.
@@ -195,16 +275,25 @@ class SongDB(object):
             given moment. It's currently hardcoded to 3540, but it can be
             overridden at runtime and it will be configurable in a
             future release.
+        budget: the number of requests that fetch() can make every
+            minute, including the retries of failed fetches.
         tracking: the number of songs that are currently being tracked.
+        shard: a tuple with the index of the shard and the total number
+            of shards if the database is a shard of a ShardedSongDB,
+            None otherwise.
     """
 
-    def __init__(self, path):
+    def __init__(self, path, shard=None):
         """Returns a new SongDB object.
 
         Args:
             path: the path to the directory where the file structure of
                 the database is located. Use init_db() to initialize a
                 new database.
+            shard: a tuple with the index of the shard and the total
+                number of shards, if the database is a shard of a
+                ShardedSongDB. Shards are better accessed through the
+                ShardedSongDB.shards attribute.
 
         Returns:
             A SongDB instance pointing to the database found in the path.
@@ -215,11 +304,22 @@ class SongDB(object):
         """
         self.path = path
         self.quota = 3540  # TODO make it configurable in the settings
+        self.shard = shard
+        self.budget = 60
         self._json_path = os.path.join(self.path, 'songs.json')
         self._blacklist_path = os.path.join(self.path, 'blacklist.json')
+        self._lock_path = os.path.join(self.path, '.lock')
+        self._journal_path = os.path.join(self.path, 'journal.jsonl')
+        self._changes_path = os.path.join(self.path, 'changes.jsonl')
+        self._charts_path = os.path.join(self.path, 'charts.bin')
+        self._retries_path = os.path.join(self.path, 'retries.json')
         self._songs = {}
         self.blacklist = []
+        self._saved = ({}, [])
+        self._events = []
+        self._charts = (0, None)
         self._cache = {}
+        self._index = {}
         self.load()
 
     def __getitem__(self, key):
@@ -237,6 +337,17 @@ class SongDB(object):
     def __contains__(self, item):
         return item in self._songs
 
+    def owns(self, songid):
+        """Tells if the provided song ID is assigned to this database.
+
+        This is always true unless the database is a shard, in which
+        case it's true for the songs assigned to the shard.
+        """
+        if self.shard is None:
+            return True
+        index, count = self.shard
+        return shard_of(songid, count) == index
+
     def is_tracking(self, songid):
         """Tells if the provided song ID is currently being tracked."""
         try:
@@ -248,6 +359,111 @@ class SongDB(object):
         """Returns the number of songs currently being tracked."""
         return len([song for song in self if song.is_tracking])
 
+    def find(self, artist=None, agency=None, lyrics=None, composition=None,
+             arrangement=None):
+        """Returns the IDs of the songs matching all the given criteria.
+
+        The lookup is performed on inverted indexes kept in memory, so
+        no song data is read from disk. Names are matched regardless of
+        case and spacing, and credited names with an alias in
+        parentheses, such as '브라더수 (Brothersu)', can be looked up
+        by either of their forms.
+
+        Args:
+            artist: the name of the artist.
+            agency: the name of the agency.
+            lyrics: a name credited for the lyrics.
+            composition: a name credited for the composition.
+            arrangement: a name credited for the arrangement.
+
+        Returns:
+            A set of song IDs. If no criteria are given, the IDs of all
+            the songs in the database are returned.
+        """
+        criteria = {'artist': artist, 'agency': agency, 'lyrics': lyrics,
+                    'composition': composition, 'arrangement': arrangement}
+        result = set(self._songs)
+        for field, name in criteria.items():
+            if name is not None:
+                key = normalize_name(name)
+                result &= self._index[field].get(key, set())
+        return result
+
+    def get_plays(self, songids=None):
+        """Returns a table of hourly plays data for several songs.
+
+        Only the data of the requested songs are read from disk, which
+        makes this method suitable for aggregate queries together with
+        find(). For example, the total hourly plays of the songs of an
+        agency are given by
+
+        db.get_plays(db.find(agency='YG Entertainment')).sum(axis=1)
+
+        Args:
+            songids: an iterable of song IDs. Defaults to all the songs
+                in the database.
+
+        Returns:
+            A Pandas DataFrame object with a hourly PeriodIndex and a
+            column for each song, labeled with its song ID. The values
+            are given as in Song.get_plays(), and hours for which a
+            song has no data are filled with NaN.
+        """
+        return self._get_stats_table('plays', songids)
+
+    def get_listeners(self, songids=None):
+        """Returns a table of hourly listeners data for several songs.
+
+        Args:
+            songids: an iterable of song IDs. Defaults to all the songs
+                in the database.
+
+        Returns:
+            A Pandas DataFrame object laid out as in SongDB.get_plays(),
+            with values given as in Song.get_listeners().
+        """
+        return self._get_stats_table('listeners', songids)
+
+    def _get_stats_table(self, column, songids):
+        if songids is None:
+            songids = self._songs
+        columns = {}
+        for songid in sorted(songids):
+            stats = self[songid]._get_stats()
+            if not stats.empty:
+                columns[songid] = stats[column]
+        if not columns:
+            return pd.DataFrame(columns=[], dtype=float)
+        return pd.concat(columns, axis=1, sort=True)
+
+    def _indexed_names(self, songid):
+        info = self._songs[songid]
+        names = {field: [info.get(field) or ''] for field in INDEXED_FIELDS}
+        credits = info.get('credits') or {}
+        names.update({role: credits.get(role, []) for role in INDEXED_CREDITS})
+        for field, values in names.items():
+            for value in values:
+                for key in name_keys(value):
+                    yield field, key
+
+    def _index_song(self, songid):
+        for field, key in self._indexed_names(songid):
+            self._index[field].setdefault(key, set()).add(songid)
+
+    def _unindex_song(self, songid):
+        for field, key in self._indexed_names(songid):
+            index = self._index[field]
+            if key in index:
+                index[key].discard(songid)
+                if not index[key]:
+                    del index[key]
+
+    def _build_index(self):
+        self._index = {field: {}
+                       for field in INDEXED_FIELDS + INDEXED_CREDITS}
+        for songid in self._songs:
+            self._index_song(songid)
+
     def prune(self, n):
         """Stops n currently tracking songs from being tracked.
 
@@ -261,14 +477,120 @@ class SongDB(object):
         Args:
             n: the number of songs to be pruned.
         """
-        # rank the song ids by streams in the last 10 days
-        performance = {}
-        for song in self:
-            streams = song.get_plays().to_timestamp().last('10D').mean()
-            performance[song.id] = streams
-        for songid in sorted(performance, key=performance.get)[:n]:
-            self[songid].is_tracking = False
-        logging.info('Disabled tracking of %d songs', min(n, performance))
+        to_prune = _rank_by_performance(self)[:n]
+        for songid in to_prune:
+            self._stop_tracking(songid)
+        logging.info('Disabled tracking of %d songs', len(to_prune))
+
+    def _stop_tracking(self, songid):
+        self[songid].is_tracking = False
+        self._events.append(self._event('prune', songid))
+
+    def _resume_tracking(self, songid):
+        self[songid].is_tracking = True
+        self._events.append(self._event('resume', songid))
+
+    def tail(self, since_offset=None, follow=False, poll_interval=1):
+        """Yields the events recorded in the change log, in order.
+
+        Every event is a dictionary with the following keys:
+
+        - 'offset': the position of the event in the change log. Offsets
+          are monotonically increasing, but not consecutive.
+        - 'type': 'sample' for a sample stored by Song.fetch(), 'add',
+          'resume' or 'prune' for a song added to the database or whose
+          tracking was resumed or stopped.
+        - 'song': the song ID.
+        - 'time': the time of the event, as an ISO 8601 string. For
+          samples, it's the time at which Genie reported the play count.
+
+        Samples also carry the 'plays' and 'listeners' totals, and added
+        songs their 'title' and 'artist'. Events about the song metadata
+        are recorded when the changes are saved with save().
+
+        The change log is read from disk as the events are yielded, so
+        consumers can process any number of events in constant memory.
+        To process only the events recorded after the last one processed
+        by a previous call, pass that event's offset as since_offset.
+
+        Args:
+            since_offset: the offset of the last event already
+                processed. Only the events following it are yielded.
+                If not given, the change log is read from the start.
+            follow: if True, wait for new events to be recorded instead
+                of stopping at the end of the change log.
+            poll_interval: the number of seconds to wait between checks
+                for new events when following the change log.
+        """
+        yield from read_changes(self._changes_path, since_offset, follow,
+                                poll_interval)
+
+    def get_charts(self):
+        """Returns the hourly snapshots of the real time top 200.
+
+        Returns:
+            A Pandas DataFrame object with a hourly PeriodIndex and a
+            column for each rank from 1 to 200. The values are the IDs
+            of the songs at each rank in the real time chart at the
+            start of the hour, as strings, or None if the rank was
+            missing from the chart. Times are given in Korean Standard Time.
+        """
+        return _charts_table(self._read_charts())
+
+    def get_ranks(self, songid):
+        """Returns the hourly ranks of a song in the real time top 200.
+
+        The song doesn't need to be in the database, as every song in
+        the chart is recorded.
+
+        Returns:
+            A Pandas Series object with a hourly PeriodIndex, with an
+            entry for every hour for which a chart snapshot has been
+            stored. The values are the ranks of the song, or NaN for the
+            hours in which the song wasn't in the chart. Times are given
+            in Korean Standard Time.
+        """
+        return rank_history(self._read_charts(), songid)
+
+    def get_chart_run(self, songid):
+        """Returns the statistics of the chart run of a song.
+
+        Returns:
+            A dictionary with the following keys: 'peak' (the highest
+            rank reached), 'hours_at_peak', 'first_charted' and
+            'last_charted' (hourly Periods), 'hours_charted',
+            'hours_in_top10', 'mean_rank' and 'longest_run' (the largest
+            number of consecutive snapshots in which the song charted).
+            Ranks and times are None if the song never charted.
+        """
+        return chart_run(self.get_ranks(songid))
+
+    def _read_charts(self):
+        # the snapshots are only read again when new ones are stored
+        try:
+            size = os.path.getsize(self._charts_path)
+        except FileNotFoundError:
+            size = 0
+        if self._charts[1] is None or self._charts[0] != size:
+            self._charts = (size, read_charts(self._charts_path))
+        return self._charts[1]
+
+    def _record_chart(self, songs):
+        hour = arrow.utcnow().floor('hour')
+        hour = int((hour - arrow.get(0)).total_seconds())
+        with locked(self._lock_path):
+            append_chart(self._charts_path, hour,
+                         [song['id'] for song in songs])
+        logging.info('Top 200 snapshot stored')
+
+    def _event(self, event_type, songid, tstamp=None, **data):
+        tstamp = tstamp or arrow.utcnow()
+        return dict(type=event_type, song=songid, time=tstamp.isoformat(),
+                    **data)
+
+    def _publish(self, events):
+        with locked(self._lock_path):
+            append_changes(self._changes_path, events)
 
     def add_from_songid(self, songid):
         """Fetches metadata and adds the song provided to the database."""
@@ -289,38 +611,99 @@ class SongDB(object):
                                        'is_tracking': True,
                                        'credits': {},
                                        'agency': songinfo['agency']}
-
-        db_path = os.path.join(self.path, '{}.pkl'.format(songinfo['id']))
-        pd.DataFrame(columns=['plays', 'listeners'], dtype=int).to_pickle(
-            db_path)
+        self._index_song(songinfo['id'])
+        self._events.append(self._event('add', songinfo['id'],
+                                        title=songinfo['title'],
+                                        artist=songinfo['artist']))
+
+        db_path = self._pkl_path(songinfo['id'])
+        with locked(self._lock_path):
+            # don't overwrite the data of a song added by another process
+            if not os.path.exists(db_path):
+                with atomic_path(db_path) as tmp_path:
+                    pd.DataFrame(columns=['plays', 'listeners'],
+                                 dtype=int).to_pickle(tmp_path)
         logging.info('Added to database (%s by %s)',
                      songinfo['title'], songinfo['artist'])
 
+    def _pkl_path(self, songid):
+        return os.path.join(self.path, '{}.pkl'.format(songid))
+
+    def _remove(self, songid):
+        self._unindex_song(songid)
+        del self._songs[songid]
+        self._cache.pop(songid, None)
+
     def load(self):
         """Loads the song metadata and the blacklist in memory.
 
         This is called by the SongDB constructor, but can also be called
-        later if one wants to revert the state of the SongDB object to
-        what it was after the last call to SongDB.save().
+        later if one wants to discard the changes made to the SongDB
+        object since the last call to SongDB.save() and to see the
+        changes saved in the meantime by other processes.
         """
-        with open(self._json_path, 'r', encoding='utf-8') as f:
-            self._songs = json.load(f)
-        with open(self._blacklist_path, 'r', encoding='utf-8') as f:
-            self.blacklist = json.load(f)
+        if os.path.exists(self._journal_path):
+            # a save was interrupted, complete it before reading
+            with locked(self._lock_path):
+                self._recover()
+        self._songs, self.blacklist = self._read()
+        self._saved = (copy.deepcopy(self._songs), list(self.blacklist))
+        self._events = []
+        self._build_index()
         logging.info('Song metadata DB and blacklist loaded')
 
-    def save(self):  # TODO make JSON formatting configurable
-        """Saves the current state of the song metadata and the blacklist.
+    def save(self):
+        """Saves the changes made to the song metadata and the blacklist.
 
         This is generally called after a call to SongDB.update()
-        or fetch().
+        or fetch(). Only the changes made since the last load() or
+        save() are written, on top of the state of the database on
+        disk, so changes saved by other processes in the meantime
+        are preserved.
         """
-        with open(self._json_path, 'w', encoding='utf-8') as f:
-            json.dump(self._songs, f, indent=4, ensure_ascii=False)
-        with open(self._blacklist_path, 'w', encoding='utf-8') as f:
-            json.dump(self.blacklist, f, indent=0)
+        ops = (diff_songs(self._saved[0], self._songs) +
+               diff_blacklist(self._saved[1], self.blacklist))
+        if not ops and not self._events:
+            logging.info('No changes to the DB in memory to be saved')
+            return
+        with locked(self._lock_path):
+            self._recover()
+            songs, blacklist = self._read()
+            if ops:
+                write_journal(self._journal_path, ops)
+                apply_ops(songs, blacklist, ops)
+                self._write(songs, blacklist)
+                clear_journal(self._journal_path)
+            if self._events:
+                append_changes(self._changes_path, self._events)
+        self._songs, self.blacklist = songs, blacklist
+        self._events = []
+        self._saved = (copy.deepcopy(self._songs), list(self.blacklist))
+        self._build_index()
         logging.info('Changes to the DB in memory saved on disk')
 
+    def _read(self):
+        with open(self._json_path, 'r', encoding='utf-8') as f:
+            songs = json.load(f)
+        with open(self._blacklist_path, 'r', encoding='utf-8') as f:
+            blacklist = json.load(f)
+        return songs, blacklist
+
+    def _write(self, songs, blacklist):
+        # TODO make JSON formatting configurable
+        dump_json(songs, self._json_path, indent=4, ensure_ascii=False)
+        dump_json(blacklist, self._blacklist_path, indent=0)
+
+    def _recover(self):
+        # must be called while holding the lock
+        ops = read_journal(self._journal_path)
+        if ops:
+            songs, blacklist = self._read()
+            apply_ops(songs, blacklist, ops)
+            self._write(songs, blacklist)
+            logging.warning('Interrupted save completed from the journal')
+        clear_journal(self._journal_path)
+
     def update(self, fetch_newest=False):
         """Asks Genie for new songs and adds them to the database.
 
@@ -358,6 +741,9 @@ class SongDB(object):
                 try:
                     newest_songs = scrape_newest(session)
                     for song in newest_songs:
+                        # skip songs assigned to other shards
+                        if not self.owns(song['id']):
+                            continue
                         # catch songs already in the db
                         if song['id'] in self:
                             logging.debug(
@@ -398,7 +784,11 @@ class SongDB(object):
 
             try:
                 top200_songs = scrape_top200(session)
+                self._record_chart(top200_songs)
                 for song in top200_songs:
+                    # skip songs assigned to other shards
+                    if not self.owns(song['id']):
+                        continue
                     # skip blacklisted songs
                     if song['id'] in self.blacklist:
                         logging.debug('Skipped: blacklisted (%s by %s)',
@@ -460,7 +850,7 @@ class SongDB(object):
             self.prune(tracking - self.quota)
 
         for songid in resume_tracking:
-            self[songid].is_tracking = True
+            self._resume_tracking(songid)
         logging.info('%d songs: tracking resumed', len(resume_tracking))
         for songinfo in to_add:
             self.add_from_songinfo(songinfo)
@@ -469,6 +859,17 @@ class SongDB(object):
     def fetch(self, minute=arrow.utcnow().minute):
         """Calls Song.fetch() for the songs scheduled for the given minute.
 
+        Songs whose fetching fails are queued to be retried later in
+        the same hour, with the requests left over from the budget of
+        the minutes at which this method is called. The retries of a
+        song are spaced by an exponential backoff with jitter, starting
+        from a minute, and a song that can't be fetched within 55
+        minutes from its first failure is given up as lost. After 5
+        consecutive failed requests to Genie, retries are suspended
+        until 5 minutes have passed without failures, so that an outage
+        doesn't cause a flood of retries. See get_retry_stats() for the
+        outcome of the retries.
+
         Args:
             minute: the minute for which the fetching must be performed.
                 All songs that have the given minute in their minute
@@ -480,13 +881,449 @@ class SongDB(object):
         for song in self:
             if song.is_tracking and song.minute == minute:
                 to_fetch.append(song)
-        logging.info('%d songs will be fetched for minute %d',
-                     len(to_fetch), minute)
+        retries, failures = self._claim_retries(self.budget - len(to_fetch))
+        logging.info('%d songs will be fetched for minute %d, %d retried',
+                     len(to_fetch), minute, len(retries))
+
+        # the consecutive failures of this call, and whether a request
+        # succeeded before them
+        run = {'failures': 0, 'reset': False}
+
+        def count(success):
+            if success:
+                run.update(failures=0, reset=True)
+            else:
+                run['failures'] += 1
+            return success
+
+        failed = []
         for song in to_fetch:
-            song.fetch()
+            if not count(song.fetch()):
+                failed.append((song.id, {'attempts': 0, 'deadline':
+                                         time.time() + RETRY_WINDOW}))
+        recovered = 0
+        retried = 0
+        dropped = 0
+        unclaimed = []
+        for songid, retry in retries:
+            consecutive = run['failures']
+            if not run['reset']:
+                consecutive += failures
+            if consecutive >= BREAKER_THRESHOLD:
+                unclaimed.append((songid, retry))
+            elif not self.is_tracking(songid):
+                # the song was pruned after its failure
+                dropped += 1
+            elif count(self[songid].fetch()):
+                retried += 1
+                recovered += 1
+            else:
+                retried += 1
+                failed.append((songid, retry))
+        self._settle_retries(failed, unclaimed, retried, recovered,
+                             dropped, run)
+
+    def get_retry_stats(self):
+        """Returns the statistics of the retries of failed fetches.
+
+        Returns:
+            A dictionary with the number of fetches that have 'failed',
+            the number of 'retries' made, the number of failed fetches
+            'recovered' by a retry, 'lost' because no retry succeeded
+            within the hour and 'dropped' because the song stopped being
+            tracked before being retried, and the number of songs
+            currently 'queued' for a retry. The numbers are counted from
+            the creation of the database.
+        """
+        state = self._read_retries()
+        return dict(state['stats'], queued=len(state['queue']))
+
+    def _claim_retries(self, n):
+        # Takes from the queue up to n retries that are due, so that
+        # overlapping calls to fetch() don't make the same retries.
+        # Returns them with the number of consecutive failures of the
+        # requests to the host.
+        host = urlparse(SONGURL).netloc
+        with locked(self._lock_path):
+            state = self._read_retries()
+            queue = state['queue']
+            breaker = state['breakers'].get(host, {'failures': 0,
+                                                   'open_until': 0})
+            now = time.time()
+            for songid, retry in list(queue.items()):
+                if retry['deadline'] < now:
+                    del queue[songid]
+                    state['stats']['lost'] += 1
+            claimed = []
+            if breaker['open_until'] <= now:
+                due = sorted((retry['due'], songid)
+                             for songid, retry in queue.items()
+                             if retry['due'] <= now)
+                for _, songid in due[:max(n, 0)]:
+                    claimed.append((songid, queue.pop(songid)))
+            dump_json(state, self._retries_path, indent=0)
+        return claimed, breaker['failures']
+
+    def _settle_retries(self, failed, unclaimed, retried, recovered,
+                        dropped, run):
+        host = urlparse(SONGURL).netloc
+        with locked(self._lock_path):
+            state = self._read_retries()
+            queue = state['queue']
+            stats = state['stats']
+            stats.setdefault('dropped', 0)
+            now = time.time()
+            queue.update(unclaimed)
+            for songid, retry in failed:
+                if retry['attempts'] == 0:
+                    stats['failed'] += 1
+                delay = RETRY_BACKOFF * 2 ** retry['attempts']
+                retry['due'] = now + delay * _jitter.uniform(0.5, 1.5)
+                retry['attempts'] += 1
+                if retry['due'] > retry['deadline']:
+                    stats['lost'] += 1
+                else:
+                    queue[songid] = retry
+            stats['retries'] += retried
+            stats['recovered'] += recovered
+            stats['dropped'] += dropped
+            # the failures of this call are applied to the count stored
+            # now, as other calls may have changed it in the meantime
+            breaker = state['breakers'].setdefault(
+                host, {'failures': 0, 'open_until': 0})
+            if run['reset']:
+                # the host has recovered, retries can resume at once
+                breaker['failures'] = run['failures']
+                breaker['open_until'] = 0
+            else:
+                breaker['failures'] += run['failures']
+            failures = breaker['failures']
+            # the cooldown only starts over when new requests fail
+            if failures >= BREAKER_THRESHOLD and failed:
+                breaker['open_until'] = now + BREAKER_COOLDOWN
+                logging.warning('Retries suspended after %d consecutive '
+                                'failed requests to %s', failures, host)
+            dump_json(state, self._retries_path, indent=0)
+        logging.info('%d songs failed, %d retries made, %d recovered',
+                     len(failed), retried, recovered)
+
+    def _read_retries(self):
+        try:
+            with open(self._retries_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {'queue': {}, 'breakers': {},
+                    'stats': {'failed': 0, 'retries': 0, 'recovered': 0,
+                              'lost': 0, 'dropped': 0}}
+
+
+class ShardedSongDB(object):
+    """This class represents a database split into several shards.
+
+    Every shard is a SongDB of its own, stored in a subdirectory of the
+    database, and songs are assigned to the shards deterministically
+    by their song ID. Each shard only adds, fetches and prunes its own
+    songs, and has its own quota, so that the shards can be kept up
+    to date by separate processes or machines, each with its own
+    request budget, which share nothing but the database directory.
+    For example, the shard with index 2 is kept up to date by calling
+    the update() and fetch() methods of the SongDB found at
+    ShardedSongDB.shards[2].
+
+    The ShardedSongDB instance itself is a merged view of all the
+    shards: it exposes the same interface for accessing the songs and
+    their data as a SongDB, and songs can be pruned across all the
+    shards. Shards can be added or removed with the rebalance() method.
+
+    When creating a new sharded database, call the init_db() function
+    found in this module with the shards argument.
+
+    Attributes:
+        path: the path to the directory where the database is stored.
+        count: the number of shards songs are assigned to.
+        shards: a list of SongDB instances, one for each shard directory
+            on disk. There can be more than count of them when the
+            number of shards has been reduced, or a rebalancing has been
+            interrupted.
+    """
+
+    def __init__(self, path):
+        """Returns a new ShardedSongDB object.
+
+        Args:
+            path: the path to the directory where the file structure of
+                the database is located. Use init_db() to initialize a
+                new database.
+
+        Raises:
+            FileNotFoundError: a file or directory required by the
+                database has not been found.
+        """
+        self.path = path
+        self._config_path = os.path.join(self.path, 'shards.json')
+        self.count = 0
+        self.shards = []
+        self.load()
+
+    def __getitem__(self, key):
+        # songs are looked up in their own shard first, but can still
+        # be found elsewhere if a rebalancing has been interrupted
+        owner = self.shards[shard_of(key, self.count)]
+        for shard in [owner] + self.shards:
+            if key in shard:
+                return shard[key]
+        raise KeyError(key)
+
+    def __iter__(self):
+        # a song found in two shards is only yielded once
+        for songid in self._songids():
+            yield self[songid]
+
+    def __len__(self):
+        return len(self._songids())
+
+    def _songids(self):
+        songids = {}
+        for shard in self.shards:
+            songids.update(dict.fromkeys(shard._songs))
+        return songids
+
+    def __contains__(self, item):
+        return any(item in shard for shard in self.shards)
+
+    def is_tracking(self, songid):
+        """Tells if the provided song ID is currently being tracked."""
+        try:
+            return self[songid].is_tracking
+        except KeyError:
+            return False
+
+    def count_tracking(self):
+        """Returns the number of songs currently being tracked."""
+        return sum(shard.count_tracking() for shard in self.shards)
+
+    def find(self, **criteria):
+        """Returns the IDs of the songs matching all the given criteria.
+
+        Accepts the same arguments as SongDB.find().
+        """
+        result = set()
+        for shard in self.shards:
+            result |= shard.find(**criteria)
+        return result
+
+    def get_plays(self, songids=None):
+        """Returns a table of hourly plays data for several songs.
+
+        See SongDB.get_plays().
+        """
+        return self._get_stats_table('plays', songids)
+
+    def get_listeners(self, songids=None):
+        """Returns a table of hourly listeners data for several songs.
+
+        See SongDB.get_listeners().
+        """
+        return self._get_stats_table('listeners', songids)
+
+    def _get_stats_table(self, column, songids):
+        if songids is None:
+            songids = self._songids()
+        tables = []
+        for shard in self.shards:
+            ids = [songid for songid in songids
+                   if songid in shard and self[songid]._parent is shard]
+            tables.append(shard._get_stats_table(column, ids))
+        tables = [table for table in tables if not table.empty]
+        if not tables:
+            return pd.DataFrame(columns=[], dtype=float)
+        return pd.concat(tables, axis=1, sort=True)
+
+    def prune(self, n):
+        """Stops n currently tracking songs from being tracked.
+
+        The songs are chosen across all the shards with the same
+        criteria as SongDB.prune(). Call save() to store the changes.
+
+        Args:
+            n: the number of songs to be pruned.
+        """
+        to_prune = _rank_by_performance(self)[:n]
+        for songid in to_prune:
+            self[songid]._parent._stop_tracking(songid)
+        logging.info('Disabled tracking of %d songs', len(to_prune))
+
+    def tail(self, since_offsets=None, follow=False, poll_interval=1):
+        """Yields the events recorded in the change logs of all shards.
+
+        Every shard has a change log of its own, see SongDB.tail(). The
+        events yielded carry the index of their shard as 'shard', and
+        are in order within each shard.
+
+        Args:
+            since_offsets: a dictionary mapping the index of a shard to
+                the offset of the last event already processed from its
+                change log. Shards not in the dictionary are read from
+                the start.
+            follow: if True, wait for new events to be recorded instead
+                of stopping at the end of the change logs.
+            poll_interval: the number of seconds to wait between checks
+                for new events when following the change logs.
+        """
+        offsets = dict(since_offsets or {})
+        while True:
+            found = False
+            for n, shard in enumerate(self.shards):
+                for event in shard.tail(offsets.get(n)):
+                    found = True
+                    offsets[n] = event['offset']
+                    event['shard'] = n
+                    yield event
+            if not follow:
+                return
+            if not found:
+                time.sleep(poll_interval)
+
+    def get_charts(self):
+        """Returns the hourly snapshots of the real time top 200.
+
+        The snapshots stored by all the shards are merged. See
+        SongDB.get_charts().
+        """
+        return _charts_table(self._read_charts())
+
+    def get_ranks(self, songid):
+        """Returns the hourly ranks of a song in the real time top 200.
+
+        See SongDB.get_ranks().
+        """
+        return rank_history(self._read_charts(), songid)
+
+    def get_chart_run(self, songid):
+        """Returns the statistics of the chart run of a song.
+
+        See SongDB.get_chart_run().
+        """
+        return chart_run(self.get_ranks(songid))
+
+    def _read_charts(self):
+        charts = [shard._read_charts() for shard in self.shards]
+        return dedup_charts(np.concatenate(charts))
+
+    def load(self):
+        """Loads the song metadata and the blacklists of all shards."""
+        with open(self._config_path, 'r', encoding='utf-8') as f:
+            self.count = json.load(f)['count']
+        self.shards = [SongDB(_shard_path(self.path, n),
+                              shard=(n, self.count))
+                       for n in range(_count_shard_dirs(self.path))]
+
+    def save(self):
+        """Saves the changes made to the song metadata of all shards."""
+        for shard in self.shards:
+            shard.save()
+
+    def rebalance(self, count):
+        """Redistributes the songs among the given number of shards.
+
+        Songs are moved between shards along with their data, so that
+        every song ends up in the shard it's assigned to. The new number
+        of shards is stored before any song is moved, and the songs are
+        copied to their new shard before being removed from the old
+        one, so that every song stays readable through the
+        ShardedSongDB if the rebalancing is interrupted, and calling
+        this method again completes it. No process should be updating
+        or fetching the database while it's being rebalanced. When the
+        number of shards is reduced, the directories of the shards
+        removed are left empty on disk.
+
+        Args:
+            count: the new number of shards.
+        """
+        for n in range(count):
+            path = _shard_path(self.path, n)
+            # the shards created by an interrupted call hold songs
+            if not os.path.exists(os.path.join(path, 'songs.json')):
+                init_db(path)
+        dump_json({'count': count}, self._config_path)
+        self.load()
+        shards = self.shards
+
+        # copy songs to their new shard before removing them from the
+        # old one, so that they can't be lost
+        moves = []
+        blacklist_moves = []
+        for shard in shards:
+            for songid in shard._songs:
+                target = shards[shard_of(songid, count)]
+                if target is not shard:
+                    moves.append((shard, target, songid))
+            for songid in shard.blacklist:
+                target = shards[shard_of(songid, count)]
+                if target is not shard:
+                    blacklist_moves.append((shard, target, songid))
+        for source, target, songid in moves:
+            with atomic_path(target._pkl_path(songid)) as tmp_path:
+                shutil.copyfile(source._pkl_path(songid), tmp_path)
+            target._songs[songid] = copy.deepcopy(source._songs[songid])
+            target._index_song(songid)
+        for source, target, songid in blacklist_moves:
+            if songid not in target.blacklist:
+                target.blacklist.append(songid)
+        for shard in shards:
+            shard.save()
+        for source, target, songid in moves:
+            source._remove(songid)
+        for source, target, songid in blacklist_moves:
+            source.blacklist.remove(songid)
+        for shard in shards:
+            shard.save()
+        for source, target, songid in moves:
+            os.remove(source._pkl_path(songid))
+        # remove the data left behind by an interrupted call, of songs
+        # whose metadata has already been removed
+        for shard in shards:
+            for name in os.listdir(shard.path):
+                songid, ext = os.path.splitext(name)
+                target = shards[shard_of(songid, count)]
+                if (ext == '.pkl' and songid not in shard and
+                        target is not shard and songid in target):
+                    os.remove(os.path.join(shard.path, name))
+
+        self.load()
+        logging.info('%d songs moved to rebalance the DB over %d shards',
+                     len(moves), count)
+
+
+def _rank_by_performance(songs):
+    # ranks the song ids by average plays/hour in the last 10 days,
+    # from the lowest
+    performance = {}
+    for song in songs:
+        streams = song.get_plays().to_timestamp().last('10D').mean()
+        performance[song.id] = streams
+    return sorted(performance, key=performance.get)
+
+
+def _charts_table(charts):
+    songs = charts['songs']
+    table = np.where(songs == 0, None, songs.astype(str))
+    return pd.DataFrame(table, index=hourly_periods(charts['hour']),
+                        columns=range(1, songs.shape[1] + 1), dtype=object)
+
+
+def _shard_path(path, n):
+    return os.path.join(path, 'shard-{}'.format(n))
+
+
+def _count_shard_dirs(path):
+    n = 0
+    while os.path.exists(os.path.join(_shard_path(path, n), 'songs.json')):
+        n += 1
+    return n
 
 
-def init_db(path):
+def init_db(path, shards=None):
     """Initializes a new database at the given path.
 
     Args:
@@ -494,9 +1331,17 @@ def init_db(path):
             new database will be created. If the directory doesn't
             exist, it will be created. It will also overwrite an
             existing database at the location.
+        shards: the number of shards the new database is split into.
+            If not given, a database without shards is created.
     Returns:
-        a SongDB instance pointing to the newly created database.
+        a SongDB instance pointing to the newly created database, or a
+        ShardedSongDB instance if the number of shards is given.
     """
+    if shards:
+        for n in range(shards):
+            init_db(_shard_path(path, n))
+        dump_json({'count': shards}, os.path.join(path, 'shards.json'))
+        return ShardedSongDB(path)
     json_path = os.path.join(path, 'songs.json')
     blacklist_path = os.path.join(path, 'blacklist.json')
     if not os.path.isdir(path):
@@ -508,4 +1353,4 @@ def init_db(path):
     return SongDB(path)
 
 
-__all__ = ['Song', 'SongDB', 'init_db']
+__all__ = ['Song', 'SongDB', 'ShardedSongDB', 'init_db']
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import json
+import os
+
+import arrow
+import pandas as pd
+import pytest
+
+import kstreams
+
+SONGIDS = [str(80000000 + n) for n in range(10)]
+
+
+def sample(hour, plays):
+    return pd.DataFrame({'plays': [plays], 'listeners': [1]},
+                        [pd.Timestamp('2018-10-01', tz='UTC') +
+                         pd.Timedelta(hours=hour)])
+
+
+@pytest.fixture
+def source(tmp_path):
+    db = kstreams.init_db(str(tmp_path / 'source'))
+    for songid in SONGIDS:
+        db.add_from_songinfo({'id': songid,
+                              'title': 'title {}'.format(songid),
+                              'artist': 'artist',
+                              'release_date': arrow.get('2018-10-01'),
+                              'agency': 'agency'})
+        for hour in range(3):
+            db[songid]._db_append(sample(hour, 1000 + hour))
+    db.blacklist.append('blacklisted')
+    db.save()
+    return db
+
+
+def test_import_exported_dump(source, tmp_path):
+    dump = str(tmp_path / 'dump.tar.gz')
+    assert kstreams.export_db(source, dump) == len(SONGIDS)
+    db = kstreams.init_db(str(tmp_path / 'db'), shards=2)
+    report = kstreams.import_db(dump, db, workers=2)
+    assert report['imported'] == len(SONGIDS)
+    assert report['rows'] == 3 * len(SONGIDS)
+    assert report['problems'] == {}
+    db.load()
+    assert sorted(song.id for song in db) == SONGIDS
+    assert all(len(song._db) == 3 for song in db)
+    assert 'blacklisted' in [songid for shard in db.shards
+                             for songid in shard.blacklist]
+    assert not os.path.exists(os.path.join(db.path, 'migration.jsonl'))
+
+
+def test_import_dumps_in_turn(source, tmp_path):
+    old_dump = str(tmp_path / 'old.tar.gz')
+    kstreams.export_db(source, old_dump)
+    source[SONGIDS[0]]._db_append(sample(3, 1003))
+    new_dump = str(tmp_path / 'new.tar.gz')
+    kstreams.export_db(source, new_dump)
+
+    db = kstreams.init_db(str(tmp_path / 'db'))
+    kstreams.import_db(old_dump, db, workers=2)
+    report = kstreams.import_db(new_dump, db, workers=2)
+    assert report['imported'] == len(SONGIDS)
+    assert report['skipped'] == 0
+    assert len(db[SONGIDS[0]]._db) == 4
+    assert len(db[SONGIDS[1]]._db) == 3
+
+
+def test_resume_interrupted_import(source, tmp_path):
+    dump = str(tmp_path / 'dump.tar.gz')
+    kstreams.export_db(source, dump)
+    db = kstreams.init_db(str(tmp_path / 'db'))
+    kstreams.import_db(dump, db, workers=2)
+
+    # leave the records of an import of the first half of the songs
+    # from the same dump, and of another dump
+    key = kstreams._migration._source_key(dump)
+    with open(os.path.join(db.path, 'migration.jsonl'), 'w') as f:
+        for songid in SONGIDS[:5]:
+            f.write(json.dumps({'id': songid, 'rows': 3,
+                                'source': key}) + '\n')
+        f.write(json.dumps({'id': SONGIDS[5], 'rows': 3,
+                            'source': 'other'}) + '\n')
+        f.write('{"id": "')
+    report = kstreams.import_db(dump, db, workers=2)
+    assert report['skipped'] == 5
+    assert report['imported'] == 5
+    with open(os.path.join(db.path, 'migration.jsonl')) as f:
+        assert [json.loads(line)['source'] for line in f] == ['other']
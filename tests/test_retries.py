@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import random
+
+import arrow
+import pytest
+
+import kstreams
+from kstreams import classes
+
+SONGIDS = [str(80000000 + n) for n in range(20)]
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1538388000.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(classes, 'time', clock)
+    monkeypatch.setattr(classes, '_jitter', random.Random(0))
+    return clock
+
+
+@pytest.fixture
+def db(tmp_path, clock):
+    db = kstreams.init_db(str(tmp_path / 'db'))
+    for n, songid in enumerate(SONGIDS):
+        db.add_from_songinfo({'id': songid,
+                              'title': 'title {}'.format(songid),
+                              'artist': 'artist',
+                              'release_date': arrow.get('2018-10-01'),
+                              'agency': 'agency'})
+        db[songid]._info['minute'] = n % 5 + 1
+    db.save()
+    return db
+
+
+def stub_fetch(monkeypatch, outcome):
+    # replaces the requests to Genie with the outcome of outcome(songid)
+    calls = []
+
+    def fetch(song):
+        calls.append(song.id)
+        return outcome(song.id)
+
+    monkeypatch.setattr(classes.Song, 'fetch', fetch)
+    return calls
+
+
+def check_stats(db):
+    stats = db.get_retry_stats()
+    assert stats['failed'] == (stats['recovered'] + stats['lost'] +
+                               stats['dropped'] + stats['queued'])
+    return stats
+
+
+def test_failed_fetches_are_accounted_for(db, clock, monkeypatch):
+    # SONGIDS[0] and SONGIDS[1] can never be fetched, the others fail
+    # now and then
+    outcomes = random.Random(0)
+    stub_fetch(monkeypatch, lambda songid: (songid not in SONGIDS[:2] and
+                                            outcomes.random() > 0.3))
+    for minute in range(1, 60):
+        if minute == 3:
+            # stops tracking SONGIDS[1] after its failure at minute 2
+            db[SONGIDS[1]].is_tracking = False
+        db.fetch(minute)
+        check_stats(db)
+        clock.sleep(60)
+    # the remaining retries are given up after the end of their window
+    clock.sleep(classes.RETRY_WINDOW)
+    db.fetch(0)
+    stats = check_stats(db)
+    assert stats['queued'] == 0
+    assert stats['recovered'] > 0
+    assert stats['lost'] >= 1
+    assert stats['dropped'] == 1
+    assert stats['retries'] > stats['recovered']
+
+
+def test_breaker_suspends_retries(db, clock, monkeypatch):
+    down = {'host': True}
+    calls = stub_fetch(monkeypatch, lambda songid: not down['host'])
+    # the 4 songs of minute 1 fail, then the 4 songs of minute 2
+    db.fetch(1)
+    clock.sleep(120)
+    db.fetch(2)
+    breaker = db._read_retries()['breakers']['www.genie.co.kr']
+    assert breaker['failures'] >= classes.BREAKER_THRESHOLD
+    assert breaker['open_until'] == clock.now + classes.BREAKER_COOLDOWN
+
+    # no retries are made while the breaker is open, even if some are due
+    del calls[:]
+    clock.sleep(60)
+    db.fetch(0)
+    assert calls == []
+    assert db.get_retry_stats()['retries'] == 0
+    assert check_stats(db)['queued'] == 8
+
+    # a successful fetch closes it before the end of the cooldown
+    down['host'] = False
+    clock.sleep(60)
+    db.fetch(3)
+    assert db._read_retries()['breakers']['www.genie.co.kr'] == {
+        'failures': 0, 'open_until': 0}
+    clock.sleep(60)
+    db.fetch(0)
+    assert clock.now < breaker['open_until']
+    assert len(calls) == 4 + 8
+    stats = check_stats(db)
+    assert stats['recovered'] == 8
+    assert stats['queued'] == 0
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import multiprocessing
+import os
+import shutil
+
+import arrow
+import pandas as pd
+import pytest
+
+import kstreams
+from kstreams import classes
+from kstreams._utils import shard_of
+
+SONGIDS = [str(80000000 + n) for n in range(40)]
+BLACKLIST = [str(90000000 + n) for n in range(40)]
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = kstreams.init_db(str(tmp_path / 'db'), shards=2)
+    for songid in SONGIDS:
+        shard = db.shards[shard_of(songid, 2)]
+        shard.add_from_songinfo({'id': songid,
+                                 'title': 'title {}'.format(songid),
+                                 'artist': 'artist',
+                                 'release_date': arrow.get('2018-10-01'),
+                                 'agency': 'agency'})
+        record = pd.DataFrame({'plays': [int(songid)], 'listeners': [1]},
+                              [pd.Timestamp('2018-10-01', tz='UTC')])
+        shard[songid]._db_append(record)
+    for songid in BLACKLIST:
+        db.shards[shard_of(songid, 2)].blacklist.append(songid)
+    db.save()
+    return db
+
+
+def check_songs(path):
+    db = kstreams.ShardedSongDB(path)
+    assert sorted(song.id for song in db) == SONGIDS
+    for songid in SONGIDS:
+        assert db[songid]._db['plays'].iloc[0] == int(songid)
+    blacklist = {songid for shard in db.shards for songid in shard.blacklist}
+    assert blacklist == set(BLACKLIST)
+    return db
+
+
+def check_rebalanced(path, count):
+    db = check_songs(path)
+    assert db.count == count
+    for n, shard in enumerate(db.shards):
+        pickles = {name[:-len('.pkl')] for name in os.listdir(shard.path)
+                   if name.endswith('.pkl')}
+        assert pickles == set(shard._songs)
+        assert all(shard_of(songid, count) == n for songid in shard._songs)
+        assert all(shard_of(songid, count) == n for songid in shard.blacklist)
+
+
+def test_rebalance(db):
+    db.rebalance(3)
+    check_rebalanced(db.path, 3)
+    db.rebalance(2)
+    check_rebalanced(db.path, 2)
+
+
+def interrupt_after(monkeypatch, obj, name, calls):
+    function = getattr(obj, name)
+    count = [0]
+
+    def interrupted(*args, **kwargs):
+        count[0] += 1
+        if count[0] > calls:
+            raise KeyboardInterrupt
+        return function(*args, **kwargs)
+    monkeypatch.setattr(obj, name, interrupted)
+
+
+@pytest.mark.parametrize('obj, name, calls', [
+    # while copying the songs to their new shards
+    (shutil, 'copyfile', 0), (shutil, 'copyfile', 5),
+    # while saving the shards with the songs copied, or removed
+    (classes.SongDB, 'save', 0), (classes.SongDB, 'save', 1),
+    (classes.SongDB, 'save', 2),
+    (classes.SongDB, 'save', 3), (classes.SongDB, 'save', 5),
+    # at the end, after the songs have been moved
+    (classes.ShardedSongDB, 'load', 2),
+])
+def test_resume_interrupted_rebalance(db, monkeypatch, obj, name, calls):
+    with monkeypatch.context() as m:
+        interrupt_after(m, obj, name, calls)
+        with pytest.raises(KeyboardInterrupt):
+            kstreams.ShardedSongDB(db.path).rebalance(3)
+    check_songs(db.path)
+    kstreams.ShardedSongDB(db.path).rebalance(3)
+    check_rebalanced(db.path, 3)
+
+
+TOP200 = [str(70000000 + n) for n in range(30)]
+
+
+class FakePage(object):
+    text = ''
+    headers = {'date': 'Mon, 01 Oct 2018 10:18:06 GMT'}
+
+    def raise_for_status(self):
+        pass
+
+
+def stub_genie():
+    # replaces every request to Genie with canned data
+    classes.scrape_top200 = lambda session: [
+        {'id': songid, 'title': 'title', 'artist': 'artist',
+         'album_id': '1'} for songid in TOP200]
+    classes.scrape_albuminfo = lambda markup: {
+        'release_date': arrow.get('2018-10-01'), 'agency': 'agency'}
+    classes.scrape_requirements = lambda markup, songid: (True, True)
+    classes.scrape_credits = lambda markup: {'lyrics': ['lyricist']}
+    classes.scrape_stats = lambda markup: {'plays': 100, 'listeners': 10}
+    classes.requests.get = lambda *args, **kwargs: FakePage()
+    classes.requests.Session.get = lambda *args, **kwargs: FakePage()
+
+
+def run_shard(path, n):
+    stub_genie()
+    shard = kstreams.ShardedSongDB(path).shards[n]
+    shard.update()
+    shard.save()
+    for minute in range(60):
+        shard.fetch(minute)
+    shard.save()
+
+
+def test_shards_in_separate_processes(tmp_path):
+    path = str(tmp_path / 'db')
+    kstreams.init_db(path, shards=3)
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=run_shard, args=(path, n))
+                 for n in range(3)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+
+    db = kstreams.ShardedSongDB(path)
+    assert sorted(song.id for song in db) == TOP200
+    assert db.count_tracking() == len(TOP200)
+    assert db.find(lyrics='lyricist') == set(TOP200)
+    for n, shard in enumerate(db.shards):
+        assert all(shard_of(songid, 3) == n for songid in shard._songs)
+    for songid in TOP200:
+        assert list(db[songid]._db['plays']) == [100]
+        assert db.get_ranks(songid).iloc[-1] == TOP200.index(songid) + 1
+    events = [(event['type'], event['song']) for event in db.tail()]
+    assert sorted(events) == sorted(
+        [('add', songid) for songid in TOP200] +
+        [('sample', songid) for songid in TOP200])
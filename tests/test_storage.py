@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import multiprocessing
+import os
+
+import arrow
+import pytest
+
+import kstreams
+from kstreams._storage import write_journal
+
+SONGIDS = [str(80000000 + n) for n in range(20)]
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = kstreams.init_db(str(tmp_path / 'db'))
+    for songid in SONGIDS:
+        db.add_from_songinfo({'id': songid,
+                              'title': 'title {}'.format(songid),
+                              'artist': 'artist',
+                              'release_date': arrow.get('2018-10-01'),
+                              'agency': 'agency'})
+    db.save()
+    return db
+
+
+def stop_tracking(path, n):
+    # every process loads the database before the others save
+    db = kstreams.SongDB(path)
+    for songid in SONGIDS[n::4]:
+        db[songid].is_tracking = False
+    db.blacklist.append('blacklisted {}'.format(n))
+    db.save()
+
+
+def test_concurrent_saves(db):
+    processes = [multiprocessing.Process(target=stop_tracking,
+                                         args=(db.path, n))
+                 for n in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+    db = kstreams.SongDB(db.path)
+    assert db.count_tracking() == 0
+    assert sorted(db.blacklist) == ['blacklisted {}'.format(n)
+                                    for n in range(4)]
+
+
+def test_save_merges_changes(db):
+    other = kstreams.SongDB(db.path)
+    db[SONGIDS[0]].is_tracking = False
+    other[SONGIDS[1]].credits = {'lyrics': ['someone']}
+    db.save()
+    other.save()
+    db.load()
+    assert not db.is_tracking(SONGIDS[0])
+    assert db.find(lyrics='someone') == {SONGIDS[1]}
+
+
+def test_load_completes_interrupted_save(db):
+    write_journal(db._journal_path,
+                  [['set', SONGIDS[0], 'is_tracking', False],
+                   ['blacklist', 'blacklisted']])
+    # a second save interrupted while writing the journal is discarded
+    with open(db._journal_path, 'a', encoding='utf-8') as f:
+        f.write('{"ops": [["set", "')
+    db = kstreams.SongDB(db.path)
+    assert not db.is_tracking(SONGIDS[0])
+    assert db.count_tracking() == len(SONGIDS) - 1
+    assert db.blacklist == ['blacklisted']
+    assert not os.path.exists(db._journal_path)
+
+
+def test_tail_resumes_after_offset(db):
+    events = list(db.tail())
+    assert [event['song'] for event in events] == SONGIDS
+    assert all(event['type'] == 'add' for event in events)
+    resumed = list(db.tail(events[4]['offset']))
+    assert resumed == events[5:]
+    assert list(db.tail(events[-1]['offset'])) == []
+
+
+def test_tail_after_interrupted_append(db):
+    last = list(db.tail())[-1]
+    with open(db._changes_path, 'ab') as f:
+        f.write(b'{"type": "sample", "so')
+    db._stop_tracking(SONGIDS[0])
+    db.save()
+    events = list(db.tail(last['offset']))
+    assert [(event['type'], event['song']) for event in events] == [
+        ('prune', SONGIDS[0])]